@@ -1,167 +1,251 @@
 import re
+import sys
+import mmap
 import json
 import argparse
+import functools
 
 from bs4 import BeautifulSoup
 
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+ATGC = re.compile(r"[atgcATGC]", re.A)
+
+REGULAR = re.compile(r'''
+\(?   # unstable
+    {}  # 祖先
+    \d+ # 位置
+    {}  # 子孫
+    !*  # reversion
+\)?'''.format(ATGC.pattern, ATGC.pattern), re.X | re.A)
+
+IRREGULAR = re.compile(r'''
+\(?                     # unstable
+  (?:
+    # ex: C459d
+    {}?
+    \d+
+    d                   # deletion
+
+  |
+    # ex: 960.XC
+    \d+
+    \.[\dX]?{}+         # insertion
+    d?                  # deletion
+
+  |
+    # ex: 59-60d
+    \d+\-\d+d           # range
+
+  |
+    # ネームスペースだけ予約？
+    reserved
+  )
+!*                      # reversion
+\)?'''.format(ATGC.pattern, ATGC.pattern), re.X | re.A)
+
+EXCEPTIONS = frozenset('''T65d G71d A249d C299d C309d A337d
+  T455d C456d C459d C498d C960d
+  A1409d A1656d A2074d A2395d A4317d
+  A5752d A5894d C5899d C7471d T15944d
+  A16166d C16187d C16193d C16257d T16325d
+
+  59-60d 105-110d 106-111d 290-291d 291-294d 8281-8289d
+
+  573.XC 960.XC 965.XC 5899.XC 8278.XC  5899.XCd!
+
+  44.1C 5899.1C 459.1C 15944.1T
+  374.1A 455.1T 2232.1A 16259.1A
+  595.1C 1719.1G 3172.1C 191.1A
+  2156.1A 55.1T 65.1T 60.1T 42.1G
+  12310.1A 291.1A 5752.1A 310.1T
+  597.1T 3229.1A 2405.1C 8276.1C
+  2484.1C 745.1T 498.1C 16169.1C
+  5899.1C 8279.1T 5740.1A 960.1C
+  3307.1A 93.1T 456.1T 356.1C
+  3158.1T
+
+  44.1C 55.1T 60.1T 65.1T 93.1T
+  191.1A 291.1A 310.1T 356.1C 374.1A
+  455.1T 456.1T 459.1C 498.1C 595.1C
+  597.1T 745.1T 960.1C 1719.1G 2156.1A
+  2232.1A 2405.1C 2484.1C 3158.1T 3172.1C
+  3229.1A 3307.1A 5740.1A 5752.1A 5899.1C
+  5899.1C 8276.1C 8279.1T 12310.1A 15944.1T
+  16169.1C 16259.1A
+  C5899.1d!  459.1Cd!
+  60.1TT 292.1AT 368.1AGAA
+  8289.1CCCCCTCTA 8289.1CCCCCTCTACCCCCTCTA
+
+  455.2T 2232.2A
+
+  (573.XC) (745.1T) (960.1C)
+  (C965d) (C16193d)
+  reserved'''.split())
+
+TABLE_TITLE = re.compile(r"mt-MRCA", re.A)
+TABLE_TITLE_BYTES = b'mt-MRCA'
+TABLE_TITLE_WORD = b'MRCA'
+TABLE_TAG = re.compile(rb'<(/?)table\b', re.I)
+
+
+@functools.lru_cache(maxsize=16384)
+def is_irregular(text):
+    return IRREGULAR.fullmatch(text)
+
+
+def is_table_title(text):
+    return TABLE_TITLE.search(text)
+
+
+@functools.lru_cache(maxsize=16384)
+def is_branch_conditions(text):
+    conditions = text.split()
+    return bool(conditions) and all(REGULAR.fullmatch(condition) or condition in EXCEPTIONS
+                                    for condition in conditions)
 
-class Strings:
-    def __init__(self, value=""):
-        if isinstance(value, Strings):
-            self.value = value.value
-        else:
-            self.value = value
-
-    def replace(self, pattern, repl):
-        self.value = re.sub(pattern, repl, self.value)
-        return self
 
 class PhylotreeParser:
     class DuplicateDetectionError(Exception): pass
-
-    class Pattern:
-        ATGC = re.compile("[atgcATGC]")
-
-        REGULAR = re.compile('''
-        \(?   # unstable
-            {}  # 祖先
-            \d+ # 位置
-            {}  # 子孫
-            !*  # reversion
-        \)?'''.format(ATGC.pattern, ATGC.pattern), re.X)
-
-        IRREGULAR = re.compile('''\A
-        \(?                     # unstable
-          (?:
-            # ex: C459d
-            {}?
-            \d+
-            d                   # deletion
-
-          |
-            # ex: 960.XC
-            \d+
-            \.[\dX]?{}+         # insertion
-            d?                  # deletion
-
-          |
-            # ex: 59-60d
-            \d+\-\d+d           # range
-
-          |
-            # ネームスペースだけ予約？
-            reserved
-          )
-        !*                      # reversion
-        \)?
-        \Z'''.format(ATGC.pattern, ATGC.pattern), re.X)
-
-        EXCEPTIONS = re.compile("|".join([re.escape(i) for i in re.split("\s+", '''T65d G71d A249d C299d C309d A337d
-          T455d C456d C459d C498d C960d
-          A1409d A1656d A2074d A2395d A4317d
-          A5752d A5894d C5899d C7471d T15944d
-          A16166d C16187d C16193d C16257d T16325d
-
-          59-60d 105-110d 106-111d 290-291d 291-294d 8281-8289d
-
-          573.XC 960.XC 965.XC 5899.XC 8278.XC  5899.XCd!
-
-          44.1C 5899.1C 459.1C 15944.1T
-          374.1A 455.1T 2232.1A 16259.1A
-          595.1C 1719.1G 3172.1C 191.1A
-          2156.1A 55.1T 65.1T 60.1T 42.1G
-          12310.1A 291.1A 5752.1A 310.1T
-          597.1T 3229.1A 2405.1C 8276.1C
-          2484.1C 745.1T 498.1C 16169.1C
-          5899.1C 8279.1T 5740.1A 960.1C
-          3307.1A 93.1T 456.1T 356.1C
-          3158.1T
-
-          44.1C 55.1T 60.1T 65.1T 93.1T
-          191.1A 291.1A 310.1T 356.1C 374.1A
-          455.1T 456.1T 459.1C 498.1C 595.1C
-          597.1T 745.1T 960.1C 1719.1G 2156.1A
-          2232.1A 2405.1C 2484.1C 3158.1T 3172.1C
-          3229.1A 3307.1A 5740.1A 5752.1A 5899.1C
-          5899.1C 8276.1C 8279.1T 12310.1A 15944.1T
-          16169.1C 16259.1A
-          C5899.1d!  459.1Cd!
-          60.1TT 292.1AT 368.1AGAA
-          8289.1CCCCCTCTA 8289.1CCCCCTCTACCCCCTCTA
-
-          455.2T 2232.2A
-
-          (573.XC) (745.1T) (960.1C)
-          (C965d) (C16193d)
-          reserved''')]), re.X)
-
-        BRANCH_CONDITION = re.compile('''(?:
-            {}
-            |
-            {}
-        )'''.format(REGULAR.pattern, EXCEPTIONS.pattern), re.X)
-
-        BRANCH_CONDITIONS = re.compile('''\A
-            {}
-            (?:\s{})*
-        \Z'''.format(BRANCH_CONDITION.pattern, BRANCH_CONDITION.pattern), re.X)
-
-        TABLE_TITLE = re.compile("mt\-MRCA")
-
-        @staticmethod
-        def is_irregular(text):
-            return PhylotreeParser.Pattern.IRREGULAR.search(text)
-
-        @staticmethod
-        def is_table_title(text):
-            return PhylotreeParser.Pattern.TABLE_TITLE.search(text)
-
-        @staticmethod
-        def is_branch_conditions(text):
-            return PhylotreeParser.Pattern.BRANCH_CONDITIONS.search(text)
+    class InvalidDepthError(Exception): pass
 
     BLANK_BRANCH_NAME = '__BRANCH__'
-    SELF_BRANCH_NAME = '__SELF__'
+    ENCODING = 'windows-1252'
 
     def __init__(self, filename):
         self.file = filename
         self.in_useful_range = False
+        self.skip_preamble = True
+        self.preamble_offset = 0
         self.queue = {} # []
-        self.raw_tree = {}
+        self.path = [] # path[i] は queue[i] に対応するノード番号
+
+        # ノードは番号で管理し、属性ごとの配列に持つ (0 番はルート)
+        self.parents = [None]
+        self.names = [None]
+        self.conditions = [None]
+        self.example_accessions = [None]
+        self.node_index = {} # (親のノード番号, 名前) -> ノード番号
 
     def parse(self):
-        for table in self.parse_html().find_all('table'):
-            self.process_table(table)
+        for (text, cells) in self.iter_rows():
+            if not self.is_in_useful_range(text):
+                continue
+            self.process_tr(cells)
+        if not self.in_useful_range and self.preamble_offset:
+            # 読み飛ばした先でタイトルが見つからなかったので、先頭から読み直す
+            self.skip_preamble = False
+            self.preamble_offset = 0
+            return self.parse()
         return self
 
+    def iter_rows(self):
+        # 各行を (行全体のテキスト, td ごとのテキスト) で返す
+        # 行全体のテキストはタイトル判定にしか使わないので、範囲内に入った後は None にする
+        if LexborHTMLParser is not None:
+            return self.iter_rows_with_selectolax()
+        if etree is not None:
+            return self.iter_rows_with_lxml()
+        return self.iter_rows_with_soup()
+
+    def iter_rows_with_selectolax(self):
+        # lexbor は bytes を UTF-8 として読むので、ここだけは Python 側でデコードする
+        html = self.read_file().decode(PhylotreeParser.ENCODING)
+        for tr in LexborHTMLParser(html).css('table tr'):
+            text = None if self.in_useful_range else tr.text()
+            yield (text, [td.text() for td in tr.css('td')])
+
+    def iter_rows_with_lxml(self):
+        with self.open_useful_range() as f:
+            for (_, tr) in etree.iterparse(f, html=True, tag='tr',
+                                           encoding=PhylotreeParser.ENCODING):
+                text = None if self.in_useful_range else ''.join(tr.itertext())
+                yield (text, [''.join(td.itertext()) for td in tr.iter('td')])
+                # 処理済みの行を捨ててメモリを一行分に抑える
+                tr.clear()
+                while tr.getprevious() is not None:
+                    del tr.getparent()[0]
+
+    def iter_rows_with_soup(self):
+        for table in self.parse_html().find_all('table'):
+            for tr in table.find_all('tr'):
+                text = None if self.in_useful_range else tr.get_text()
+                yield (text, [td.get_text() for td in tr.find_all('td')])
+
     def parse_html(self):
-        return BeautifulSoup(self.read_file(), 'html.parser')
+        return BeautifulSoup(self.read_file(), 'html.parser',
+                             from_encoding=PhylotreeParser.ENCODING)
 
     def read_file(self):
-        with open(self.file, 'r', encoding='windows-1252') as f:
+        with self.open_useful_range() as f:
             return f.read()
 
-    def process_table(self, table):
-        for tr in table.find_all('tr'):
-            if not self.is_in_useful_range(tr.get_text()):
-                continue 
-            self.process_tr(tr)
-
-    def process_tr(self, tr):
-        cols = []
+    def open_useful_range(self):
+        f = open(self.file, 'rb')
+        # パイプなどシークできない入力は読み飛ばさず、今の位置からそのまま読む
+        if self.skip_preamble and f.seekable():
+            try:
+                self.preamble_offset = self.find_useful_offset(f)
+                f.seek(self.preamble_offset)
+            except BaseException:
+                f.close()
+                raise
+        return f
+
+    def find_useful_offset(self, f):
+        # タイトルを含む table より前は読み飛ばす (見つからなければ今の位置から)
+        try:
+            html = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # 空のファイルや mmap できない入力
+            return f.tell()
+        with html:
+            title = html.find(TABLE_TITLE_BYTES)
+            # タグで分断されたタイトルが先にあるかもしれない場合は読み飛ばさない
+            if title < 0 or html.find(TABLE_TITLE_WORD, 0, title) >= 0:
+                return f.tell()
+
+            # 入れ子の table に止まらないよう、タイトルの位置でまだ閉じていない一番外側の table まで戻る
+            depth = 0
+            start = f.tell()
+            for tag in TABLE_TAG.finditer(html, 0, title):
+                if tag.group(1):
+                    depth = max(depth - 1, 0)
+                else:
+                    if depth == 0:
+                        start = tag.start()
+                    depth += 1
+            return start if depth else f.tell()
+
+    def process_tr(self, cells):
+        previous = last = ''
         conditions = []
         depth = 0
         haplogroup_candidates = []
+        trim_white_space = self.trim_white_space
 
-        for (i, td) in enumerate(tr.find_all('td')):
-            raw = td.get_text()
-            text = self.trim_white_space(raw)
-            cols.append(text)
+        for (i, raw) in enumerate(cells):
+            text = trim_white_space(raw)
+            previous, last = last, text
             if len(text) == 0:
                 continue
 
-            if PhylotreeParser.Pattern.is_branch_conditions(text):
-                conditions = text.split(' ')
+            if is_branch_conditions(text):
+                conditions = text.split()
                 depth = i - 1
             else:
                 haplogroup_candidates.append(text)
@@ -169,12 +253,12 @@ class PhylotreeParser:
         if len(conditions) == 0:
             return
 
-        example_accessions = self.extract_example_accessions(cols)
+        example_accessions = self.extract_example_accessions(previous, last)
         haplogroup = self.detect_haplogroup(haplogroup_candidates, example_accessions)
         self.grow_tree(haplogroup, conditions, example_accessions, depth)
 
-    def extract_example_accessions(self, cols):
-        return [cols[i] for i in [-2, -1] if cols[i]]
+    def extract_example_accessions(self, *cols):
+        return [col for col in cols if col]
 
     def detect_haplogroup(self, candidates, example_accessions):
         haplogroup = ''
@@ -190,66 +274,86 @@ class PhylotreeParser:
         return haplogroup
 
     def grow_tree(self, haplogroup, conditions, example_accessions, depth):
+        # 変異の列が先頭にある行は親が決まらないので受け付けない
+        if depth < 0:
+            raise PhylotreeParser.InvalidDepthError(depth)
         self.queue[depth] = haplogroup
-        node = self.get_deep_hash(self.raw_tree, self.queue, list(range(depth + 1)))
-        node[PhylotreeParser.SELF_BRANCH_NAME] = {
-                    'conditions': conditions,
-                    'example_accessions': example_accessions
-                }
-
-    def get_deep_hash(self, dic, arr, itr):
-        idx, itr = itr[0], itr[1:]
-        key = arr[idx]
-        if not key in dic:
-            dic[key] = {}
-        next_dic = dic[key]
-        if len(itr) == 0:
-            return next_dic
-        return self.get_deep_hash(next_dic, arr, itr) 
+        node = self.get_node(depth)
+        self.conditions[node] = conditions
+        self.example_accessions[node] = example_accessions
+
+    def get_node(self, depth):
+        # queue[depth] だけが変わるので、それより浅いノードは前の行の path を再利用できる
+        del self.path[depth:]
+        node = self.path[-1] if self.path else 0
+        for i in range(len(self.path), depth + 1):
+            child = self.node_index.get((node, self.queue[i]))
+            if child is None:
+                child = self.add_node(node, self.queue[i])
+            node = child
+            self.path.append(node)
+        return node
+
+    def add_node(self, parent, name):
+        node = len(self.names)
+        self.parents.append(parent)
+        self.names.append(name)
+        self.conditions.append(None)
+        self.example_accessions.append(None)
+        self.node_index[(parent, name)] = node
+        return node
 
     def prettify(self):
-        return self._prettify(self.raw_tree)
-
-    def _prettify(self, raw_tree):
-        self_branch = None
-        if PhylotreeParser.SELF_BRANCH_NAME in raw_tree:
-            self_branch = raw_tree[PhylotreeParser.SELF_BRANCH_NAME]
-        descentants = {}
-        for (name, branches) in raw_tree.items():
-            if name != PhylotreeParser.SELF_BRANCH_NAME:
-                descentants[name] = self._prettify(branches)
-
-        pretty_tree = {}
-        if self_branch:
-            pretty_tree['conditions'] = self_branch['conditions']
-            pretty_tree['example_accessions'] = self_branch['example_accessions']
-
-        if len(descentants) != 0:
-            pretty_tree['descentants'] = descentants
-            
-        return pretty_tree
+        # 親は必ず子より小さい番号なので、番号順に一度なめるだけで組み立てられる
+        pretty_nodes = []
+        for node in range(len(self.names)):
+            pretty_node = {}
+            if self.conditions[node]:
+                pretty_node['conditions'] = self.conditions[node]
+                pretty_node['example_accessions'] = self.example_accessions[node]
+            pretty_nodes.append(pretty_node)
+
+            if node != 0:
+                parent = pretty_nodes[self.parents[node]]
+                parent.setdefault('descentants', {})[self.names[node]] = pretty_node
+
+        return pretty_nodes[0]
 
     def prettify_to_array(self):
         return self._prettify_to_array(self.prettify())
 
-    def _prettify_to_array(self, raw_tree, pretty_tree=[], parent=[]):
-        for name, branches in raw_tree['descentants'].items():
-            current = [*parent, { 'name': name, 'conditions': branches['conditions'] }]
-            pretty_tree.append(current)
-            if branches['descentants']:
-                self._prettify_to_array(branches, pretty_tree, parent)
+    def _prettify_to_array(self, raw_tree, pretty_tree=None, parent=None):
+        if pretty_tree is None:
+            pretty_tree = []
+        if parent is None:
+            parent = []
+
+        stack = [(raw_tree, parent)]
+        while stack:
+            tree, path = stack.pop()
+            if path is not parent:
+                pretty_tree.append(path)
+            for name, branches in reversed(list(tree.get('descentants', {}).items())):
+                current = [*path, { 'name': name, 'conditions': branches.get('conditions') }]
+                stack.append((branches, current))
 
         return pretty_tree
-        
+
     def trim_white_space(self, text):
-        return Strings(text).replace('^\s+', '').replace('\s+$', '').replace('\s+', ' ').value
+        return ' '.join(text.split())
 
     def is_in_useful_range(self, text):
-        if not self.in_useful_range and self.Pattern.is_table_title(text):
+        if not self.in_useful_range and is_table_title(text):
             self.in_useful_range = True
             return False
         return self.in_useful_range
 
+def dump_json(tree):
+    if orjson is not None:
+        return orjson.dumps(tree, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+    # orjson と同じバイト列になるように揃える
+    return json.dumps(tree, sort_keys=True, indent=2, ensure_ascii=False).encode('utf-8')
+
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--input', '-i', required=True,
@@ -258,4 +362,4 @@ if __name__ == '__main__':
     parser = PhylotreeParser(args.input)
     parser.parse()
     pretty = parser.prettify()
-    print(json.dumps(pretty, sort_keys=True, indent=4))
+    sys.stdout.buffer.write(dump_json(pretty) + b'\n')
@@ -0,0 +1,147 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import phylotree_parser
+from phylotree_parser import PhylotreeParser
+
+
+ROWS = '''
+<tr><td>H</td><td>A123G T456C</td><td></td><td>AB000001</td></tr>
+<tr><td></td><td>H1</td><td>G789A</td><td></td><td></td></tr>
+'''
+
+EXPECTED = {
+    'descentants': {
+        'H': {
+            'conditions': ['A123G', 'T456C'],
+            'example_accessions': ['AB000001'],
+            'descentants': {
+                'H1': {
+                    'conditions': ['G789A'],
+                    'example_accessions': [],
+                },
+            },
+        },
+    },
+}
+
+
+def backends():
+    # 使える HTML バックエンドごとに、それだけが選ばれるようにモジュールを差し替える
+    yield ('soup', {'LexborHTMLParser': None, 'etree': None})
+    if phylotree_parser.etree is not None:
+        yield ('lxml', {'LexborHTMLParser': None})
+    if phylotree_parser.LexborHTMLParser is not None:
+        yield ('selectolax', {})
+
+
+class PhylotreeParserTest(unittest.TestCase):
+    def write_html(self, html):
+        fd, path = tempfile.mkstemp(suffix='.htm')
+        with os.fdopen(fd, 'w', encoding=PhylotreeParser.ENCODING) as f:
+            f.write(html)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def parse(self, path):
+        return PhylotreeParser(path).parse().prettify()
+
+    def open_pipe(self, html):
+        # シークできない入力として、別スレッドから書き込むパイプを /dev/fd 経由で渡す
+        (r, w) = os.pipe()
+        self.addCleanup(os.close, r)
+
+        def write():
+            with os.fdopen(w, 'wb') as f:
+                f.write(html.encode(PhylotreeParser.ENCODING))
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.addCleanup(writer.join)
+        return '/dev/fd/{}'.format(r)
+
+    def test_title_in_th(self):
+        path = self.write_html('<table><tr><th>mt-MRCA</th></tr>{}</table>'.format(ROWS))
+        for (name, patches) in backends():
+            with self.subTest(backend=name), mock.patch.dict(phylotree_parser.__dict__, patches):
+                self.assertEqual(self.parse(path), EXPECTED)
+
+    @unittest.skipUnless(os.path.isdir('/dev/fd'), 'requires /dev/fd')
+    def test_pipe_input(self):
+        html = '<p>preamble</p><table><tr><td>mt-MRCA</td></tr>{}</table>'.format(ROWS)
+        for (name, patches) in backends():
+            with self.subTest(backend=name), mock.patch.dict(phylotree_parser.__dict__, patches):
+                self.assertEqual(self.parse(self.open_pipe(html)), EXPECTED)
+
+    def test_no_title(self):
+        path = self.write_html('<table>{}</table>'.format(ROWS))
+        with open(path, 'rb') as f:
+            self.assertEqual(PhylotreeParser(path).find_useful_offset(f), 0)
+        for (name, patches) in backends():
+            with self.subTest(backend=name), mock.patch.dict(phylotree_parser.__dict__, patches):
+                self.assertEqual(self.parse(path), {})
+
+    def test_nested_table_before_title(self):
+        # タイトルと同じ table の中で、タイトルより前に入れ子の table がある
+        path = self.write_html('<table><tr><td><table><tr><td>note</td></tr></table></td></tr>'
+                               '<tr><td>mt-MRCA</td></tr>{}</table>'.format(ROWS))
+        with open(path, 'rb') as f:
+            self.assertEqual(PhylotreeParser(path).find_useful_offset(f), 0)
+        for (name, patches) in backends():
+            with self.subTest(backend=name), mock.patch.dict(phylotree_parser.__dict__, patches):
+                self.assertEqual(self.parse(path), EXPECTED)
+
+    def test_split_title_before_literal_title(self):
+        # 本物のタイトルはタグで分断され、その後ろに地の文で mt-MRCA が出てくる
+        path = self.write_html('<table><tr><td>mt-<span>MRCA</span></td></tr>{}</table>'
+                               '<table><tr><td>see mt-MRCA</td></tr></table>'.format(ROWS))
+        for (name, patches) in backends():
+            with self.subTest(backend=name), mock.patch.dict(phylotree_parser.__dict__, patches):
+                self.assertEqual(self.parse(path), EXPECTED)
+
+    def test_title_hint_outside_row_text(self):
+        # バイト列で見つかる mt-MRCA はコメントの中だけで、本物のタイトルは文字参照を含む
+        path = self.write_html('<table><tr><td>mt-MR&#67;A</td></tr>{}</table>'
+                               '<table><tr><td><!-- mt-MRCA --></td></tr></table>'.format(ROWS))
+        for (name, patches) in backends():
+            with self.subTest(backend=name), mock.patch.dict(phylotree_parser.__dict__, patches):
+                self.assertEqual(self.parse(path), EXPECTED)
+
+    def test_prettify_to_array(self):
+        # C の下の B は深さ 2 の X のために作られるだけで、自身の変異を持たない
+        row = '<tr>{}<td>{}</td><td>{}</td><td></td><td></td></tr>'
+        rows = ''.join(row.format('<td></td>' * depth, name, condition)
+                       for (depth, name, condition) in [(0, 'A', 'A1G'), (1, 'B', 'C2T'),
+                                                        (0, 'C', 'G3A'), (2, 'X', 'T4C')])
+        path = self.write_html('<table><tr><td>mt-MRCA</td></tr>{}</table>'.format(rows))
+        parser = PhylotreeParser(path).parse()
+        expected = [
+            [{'name': 'A', 'conditions': ['A1G']}],
+            [{'name': 'A', 'conditions': ['A1G']}, {'name': 'B', 'conditions': ['C2T']}],
+            [{'name': 'C', 'conditions': ['G3A']}],
+            [{'name': 'C', 'conditions': ['G3A']}, {'name': 'B', 'conditions': None}],
+            [{'name': 'C', 'conditions': ['G3A']}, {'name': 'B', 'conditions': None},
+             {'name': 'X', 'conditions': ['T4C']}],
+        ]
+        self.assertEqual(parser.prettify_to_array(), expected)
+        # 二回目の呼び出しに前回の結果が混ざらないこと
+        self.assertEqual(parser.prettify_to_array(), expected)
+
+    @unittest.skipIf(phylotree_parser.orjson is None, 'requires orjson')
+    def test_dump_json_without_orjson(self):
+        tree = {
+            'descentants': {
+                'L3\u00e9\u00a0x': {'conditions': ['A123G'], 'example_accessions': []},
+                'H': {'conditions': ['T456C', 'G789A!'], 'example_accessions': ['AB000001']},
+            },
+        }
+        with_orjson = phylotree_parser.dump_json(tree)
+        with mock.patch.object(phylotree_parser, 'orjson', None):
+            self.assertEqual(phylotree_parser.dump_json(tree), with_orjson)
+
+
+if __name__ == '__main__':
+    unittest.main()